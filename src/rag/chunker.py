@@ -1,31 +1,97 @@
 
 # chunker.py
+from functools import lru_cache
+from typing import Callable, Iterable, Optional
+
 from langchain_text_splitters import MarkdownHeaderTextSplitter, RecursiveCharacterTextSplitter
 
 
-def chunking(document: str, chunk_size, chunk_overlap):
-    headers_to_split_on = [
-        ("#", "Header 1"),
-        ("##", "Header 2"),
-        ("###", "Header 3"),
-        ("####", "Header 4"),
-    ]
-    
-    markdown_splitter = MarkdownHeaderTextSplitter(headers_to_split_on)
-    md_header_splits = markdown_splitter.split_text(document)
-    
-    if not md_header_splits:
-        print("Warning: No content to split.")
-        return
+HEADERS_TO_SPLIT_ON = [
+    ("#", "Header 1"),
+    ("##", "Header 2"),
+    ("###", "Header 3"),
+    ("####", "Header 4"),
+]
+
+MARKDOWN_SPLITTER = MarkdownHeaderTextSplitter(HEADERS_TO_SPLIT_ON)
+
+# Rough characters-per-token ratio, used when no tokenizer is available
+CHARS_PER_TOKEN = 4
+
+
+@lru_cache(maxsize=4)
+def _get_length_function(tokenizer_name: Optional[str]) -> Callable[[str], int]:
+    """
+    Return a function measuring text length in tokens of the embedding model.
+    Falls back to a character-based estimate if the tokenizer can't be loaded.
+    """
+    if tokenizer_name:
+        try:
+            from transformers import AutoTokenizer
+            tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
+            return lambda text: len(tokenizer.encode(text, add_special_tokens=False))
+        except ImportError:
+            print("Warning: transformers is not installed. Estimating token counts from characters.")
+        except Exception as e:
+            print(f"Warning: Could not load tokenizer '{tokenizer_name}' ({e}). Estimating token counts from characters.")
     
-    text_splitter = RecursiveCharacterTextSplitter(
+    return lambda text: -(-len(text) // CHARS_PER_TOKEN)
+
+
+@lru_cache(maxsize=8)
+def _get_text_splitter(chunk_size, chunk_overlap, tokenizer_name) -> RecursiveCharacterTextSplitter:
+    return RecursiveCharacterTextSplitter(
         chunk_size=chunk_size,
-        chunk_overlap=chunk_overlap
+        chunk_overlap=chunk_overlap,
+        length_function=_get_length_function(tokenizer_name)
     )
+
+
+def _merge_small_chunks(chunks: list[str], chunk_size, min_chunk_size, length_function) -> list[str]:
+    """Merge chunks shorter than min_chunk_size into a neighbour while the result fits in chunk_size."""
+    merged = []
+    for chunk in chunks:
+        if merged and min(length_function(merged[-1]), length_function(chunk)) < min_chunk_size:
+            candidate = f"{merged[-1]}\n\n{chunk}"
+            if length_function(candidate) <= chunk_size:
+                merged[-1] = candidate
+                continue
+        merged.append(chunk)
+    return merged
+
+
+def chunking(documents: Iterable[str], chunk_size, chunk_overlap, tokenizer_name: Optional[str] = None, min_chunk_size: int = 0):
+    """
+    Split Markdown documents into chunks of at most chunk_size tokens,
+    first by headers and then recursively within each section.
+    Documents are split one at a time, so they never need to be joined.
+    """
+    if isinstance(documents, str):
+        documents = [documents]
     
-    # Split the markdown sections into chunks
+    text_splitter = _get_text_splitter(chunk_size, chunk_overlap, tokenizer_name)
+    length_function = _get_length_function(tokenizer_name)
+    
+    # Split the markdown sections of each document into chunks
     chunks = []
-    for section in md_header_splits:
-        chunks.extend(text_splitter.split_text(section.page_content))
+    has_sections = False
+    for document in documents:
+        for section in MARKDOWN_SPLITTER.split_text(document):
+            has_sections = True
+            content = section.page_content.strip()
+            if not content:
+                continue
+            # Sections that already fit don't need the recursive separator search
+            if length_function(content) <= chunk_size:
+                chunks.append(content)
+            else:
+                chunks.extend(text_splitter.split_text(content))
+    
+    if not has_sections:
+        print("Warning: No content to split.")
+        return
+    
+    if min_chunk_size:
+        chunks = _merge_small_chunks(chunks, chunk_size, min_chunk_size, length_function)
     
     return chunks
@@ -3,30 +3,38 @@
 import os
 import uuid
 import hashlib
+import tempfile
 
 from llama_cloud_services import LlamaParse
 from dotenv import load_dotenv
-import pymupdf
 
-def load_document(file_path: str):
-    if ".pdf" in file_path:
-        return _load_pdf(file_path=file_path)
+PROCESSED_DIR = "data/processed"
+# Written between parsed documents in the cached Markdown file
+DOCUMENT_SEPARATOR = "\n\n---\n\n"
 
-def _load_pdf(file_path: str):
-    doc = pymupdf.open(file_path)
-    return doc
+def _split_markdown_documents(markdown: str) -> list[str]:
+    return [text for text in markdown.split(DOCUMENT_SEPARATOR) if text.strip()]
 
-def get_doc_id(file_path: str):
-    doc = load_document(file_path=file_path)
-    text = "".join(page.get_text() for page in doc)
-    doc.close()
-
-    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+def get_file_hash(file_path: str):
+    with open(file_path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()[:16]
 
 def parse_pdf_to_md(file_path: str): # <-- Parameter is the full path
     """
     Parses a PDF file using LlamaCloud and saves the result as a Markdown file.
+    The Markdown is cached under a hash of the PDF bytes, so unchanged
+    files are read back from disk instead of being sent to LlamaCloud again.
     """
+    # Hash the raw bytes rather than the PyMuPDF text layer: scanned PDFs have no
+    # text layer, and would otherwise all share the same cache entry
+    file_hash = get_file_hash(file_path=file_path)
+    output_file_path = os.path.join(PROCESSED_DIR, f"{file_hash}.md")
+
+    if os.path.exists(output_file_path):
+        print(f"--> Found cached markdown for '{file_path}' at '{output_file_path}'")
+        with open(output_file_path, "r", encoding="utf-8") as f:
+            return _split_markdown_documents(f.read())
+
     print("--> Initializing LlamaParse...")
     parser = LlamaParse(
         verbose=True,
@@ -42,23 +50,26 @@ def parse_pdf_to_md(file_path: str): # <-- Parameter is the full path
         print("--> WARNING: No document was returned from the parser. The output file will not be created.")
         return []
     
-    # --- FIXED OUTPUT PATH LOGIC ---
-    # Get just the filename from the full path
-    file_name_only = os.path.basename(file_path)
-    output_file_path = f"data/processed/{file_name_only.replace('.pdf', '')}.md"
-    
     print(f"--> Writing {len(document)} document to '{output_file_path}'...")
     
     # Ensure the output directory exists
-    os.makedirs(os.path.dirname(output_file_path), exist_ok=True)
+    os.makedirs(PROCESSED_DIR, exist_ok=True)
+
+    markdown = "".join(f"{doc.text_resource.text}{DOCUMENT_SEPARATOR}" for doc in document)
 
-    with open(output_file_path, "w", encoding="utf-8") as f:
-        for doc in document:
-            f.write(doc.text_resource.text)
-            f.write("\n\n---\n\n")
+    # Write to a temporary file first so a partial write never looks like a valid cache entry
+    fd, tmp_path = tempfile.mkstemp(dir=PROCESSED_DIR, suffix=".md.tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(markdown)
+        os.replace(tmp_path, output_file_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
 
     print(f"--> Successfully parsed and wrote content to '{output_file_path}'")
-    return document
+    # Return the same per-document texts as a cache hit, so callers hash identical text either way
+    return _split_markdown_documents(markdown)
 
 
 if __name__ == "__main__":
@@ -1,14 +1,25 @@
+import asyncio
 import chromadb
+import numpy as np
+import requests
 import yaml
+import hashlib
 import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 from chromadb.api.models.Collection import Collection
 from dotenv import load_dotenv
-from typing import Optional, List
+from typing import Iterator, Optional, List
 import os
 
+# Prefer the libyaml-backed loader when PyYAML was built with it
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
 from embeddings import create_embedding_function
-from loader import parse_pdf_to_md, get_doc_id
+from loader import parse_pdf_to_md
 from chunker import chunking
 
 # Configure logging
@@ -29,7 +40,7 @@ class ChromaClient:
     def __init__(self, config_path: str = "config/vectorstore.yaml"):
         try:
             with open(config_path, "r") as file:
-                self.config = yaml.safe_load(file)
+                self.config = yaml.load(file, Loader=SafeLoader)
             if 'vectorstore' not in self.config or 'settings' not in self.config['vectorstore']:
                 raise KeyError("Config file must have 'vectorstore.settings' structure.")
         except FileNotFoundError:
@@ -38,9 +49,25 @@ class ChromaClient:
             raise ValueError(f"Error parsing YAML file: {e}")
 
         settings = self.config['vectorstore']['settings']
+        # Snapshot settings read on every query/ingest
+        self._top_k = settings.get('top_k_results', 5)
+        self._chunk_size = settings.get('chunk_size', 200)
+        self._chunk_overlap = settings.get('chunk_overlap', 20)
+        self._min_chunk_size = settings.get('min_chunk_size', 0)
+        self._embed_batch_size = settings.get('embed_batch_size', 64)
+        self._ingest_workers = settings.get('ingest_workers', 4)
         db_path = settings.get('path', './chroma_db')
         Path(db_path).parent.mkdir(parents=True, exist_ok=True)
         self.client = self._create_client(db_path)
+        self._embedding_function = create_embedding_function()
+        # Configured next to EMBEDDING_MODEL so chunk sizes follow the model actually used
+        self._tokenizer_name = self._embedding_function.tokenizer
+        # Long-lived threads for embedding calls, so each keeps its own HTTP session
+        # (and keep-alive connection to Ollama) across documents
+        self._embed_executor = ThreadPoolExecutor(
+            max_workers=max(1, self._ingest_workers),
+            thread_name_prefix="embed"
+        )
 
         self._collections: dict[str, Collection] = {}
         for col_cfg in settings.get('collections', []):
@@ -61,7 +88,7 @@ class ChromaClient:
         return self.client.get_or_create_collection(
             name=name,
             metadata=metadata,
-            embedding_function=create_embedding_function()
+            embedding_function=self._embedding_function
         )
 
     def get_collection(self, name: str) -> Optional[Collection]:
@@ -71,54 +98,59 @@ class ChromaClient:
     def collections(self) -> dict[str, Collection]:
         return self._collections
 
+    @property
+    def ingest_workers(self) -> int:
+        return self._ingest_workers
+
     def query(self, collection_name: str, query_texts: list[str]) -> dict:
         """Query a collection with the given texts."""
         collection = self.get_collection(collection_name)
         if not collection:
             raise ValueError(f"Collection '{collection_name}' is not defined in the configuration file.")
         
-        k_results = self.config['vectorstore']['settings'].get('top_k_results', 5)
-        
         logger.info(f"Querying collection '{collection_name}' with {len(query_texts)} queries")
+        # Embed through the cache instead of letting Chroma re-embed every query
+        query_embeddings = self._embedding_function.embed_queries(query_texts)
         results = collection.query(
-            query_texts=query_texts,
-            n_results=k_results
+            query_embeddings=query_embeddings,
+            n_results=self._top_k
         )
         return results
     
-    def _extract_text_from_documents(self, documents: List) -> str:
+    def _extract_text_from_documents(self, documents: List) -> Iterator[str]:
         """
-        Safely extract text from parsed documents.
+        Safely extract text from parsed documents, one document at a time.
         Handles multiple possible document structures from LlamaParse.
         """
         if not documents:
             logger.warning("No documents provided for text extraction")
-            return ""
+            return
         
-        text_parts = []
+        extracted = 0
         
         for i, doc in enumerate(documents):
             try:
                 # Try different possible attributes
                 if hasattr(doc, 'text'):
-                    text_parts.append(doc.text)
+                    text = doc.text
                 elif hasattr(doc, 'text_resource') and hasattr(doc.text_resource, 'text'):
-                    text_parts.append(doc.text_resource.text)
+                    text = doc.text_resource.text
                 elif hasattr(doc, 'page_content'):
-                    text_parts.append(doc.page_content)
+                    text = doc.page_content
                 elif isinstance(doc, str):
-                    text_parts.append(doc)
+                    text = doc
                 else:
                     logger.warning(f"Document {i} has unrecognized structure: {type(doc)}")
+                    continue
             except Exception as e:
                 logger.error(f"Error extracting text from document {i}: {e}")
                 continue
+            
+            extracted += 1
+            yield text
         
-        if not text_parts:
+        if not extracted:
             logger.error("Could not extract text from any documents")
-            return ""
-        
-        return "\n\n".join(text_parts)
     
     def _check_document_exists(self, collection: Collection, doc_id: str) -> bool:
         """Check if a document with the given ID already exists in the collection."""
@@ -132,14 +164,128 @@ class ChromaClient:
     def _get_existing_chunk_ids(self, collection: Collection, doc_id: str) -> set:
         """Get all chunk IDs for a given document."""
         try:
-            # Query for chunks that start with the document ID
-            all_items = collection.get()
-            chunk_ids = {id for id in all_items['ids'] if id.startswith(f"{doc_id}_")}
-            return chunk_ids
+            # Filter on the doc_id metadata so only this document's IDs are fetched
+            existing = collection.get(where={"doc_id": doc_id}, include=[])
+            return set(existing['ids'])
         except Exception as e:
             logger.warning(f"Error getting existing chunks: {e}")
             return set()
 
+    def _delete_stale_chunks(self, collection: Collection, source_path: str, doc_id: str) -> None:
+        """Remove chunks indexed from earlier versions of the same source file."""
+        try:
+            collection.delete(where={"$and": [{"source_path": source_path}, {"doc_id": {"$ne": doc_id}}]})
+        except Exception as e:
+            logger.warning(f"Error deleting stale chunks for {source_path}: {e}")
+
+    def delete_legacy_chunks(self, collection_name: str) -> int:
+        """
+        Delete chunks written without a 'source_path', i.e. before sources were
+        tracked by path. Their doc_ids were derived differently, so re-ingesting
+        a file adds new chunks next to them instead of replacing them.
+        This scans the whole collection and is meant to be run once, explicitly.
+        
+        Returns:
+            Number of chunks deleted
+        """
+        collection = self.get_collection(collection_name)
+        if not collection:
+            raise ValueError(f"Collection '{collection_name}' is not defined in the configuration file.")
+        
+        items = collection.get(include=["metadatas"])
+        legacy_ids = [
+            chunk_id for chunk_id, metadata in zip(items['ids'], items['metadatas'])
+            if not metadata or "source_path" not in metadata
+        ]
+        if legacy_ids:
+            collection.delete(ids=legacy_ids)
+        logger.info(f"Deleted {len(legacy_ids)} legacy chunks from collection '{collection_name}'")
+        return len(legacy_ids)
+
+    @staticmethod
+    def _get_file_fingerprint(file_path: str) -> str:
+        """Cheap change marker for a source file, based on its size and mtime."""
+        stat = os.stat(file_path)
+        return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+    def _get_unchanged_document(self, collection: Collection, source_path: str, fingerprint: str) -> Optional[dict]:
+        """
+        Return the stored metadata of a document indexed from this exact
+        version of the source file, or None if the file is new or changed.
+        """
+        try:
+            existing = collection.get(
+                where={"$and": [{"source_path": source_path}, {"source_fingerprint": fingerprint}]},
+                limit=1,
+                include=["metadatas"]
+            )
+            return existing['metadatas'][0] if existing['ids'] else None
+        except Exception as e:
+            logger.warning(f"Error checking source fingerprint: {e}")
+            return None
+
+    async def _add_in_batches(
+        self,
+        collection: Collection,
+        chunks: List[str],
+        ids: List[str],
+        metadatas: List[dict]
+    ) -> None:
+        """
+        Embed and add chunks to a collection in slices of at most `embed_batch_size`.
+        Writes are pipelined: while one batch is being written to Chroma, the
+        next one is already being embedded. If the embedding server fails on a
+        slice, the batch size is halved and the slice retried, down to a single
+        chunk per request.
+        """
+        # At most two writes in flight, so embeddings never pile up in memory
+        write_slots = asyncio.Semaphore(2)
+        writes = []
+
+        async def write(start: int, end: int, embeddings: List[np.ndarray]) -> None:
+            try:
+                await asyncio.to_thread(
+                    collection.add,
+                    documents=chunks[start:end],
+                    embeddings=embeddings,
+                    ids=ids[start:end],
+                    metadatas=metadatas[start:end]
+                )
+            finally:
+                write_slots.release()
+
+        batch_size = max(1, self._embed_batch_size)
+        start = 0
+        try:
+            while start < len(chunks):
+                # Stop embedding as soon as an earlier write has failed; the
+                # document will be rolled back anyway
+                for task in writes:
+                    if task.done() and not task.cancelled() and task.exception():
+                        raise task.exception()
+                end = start + batch_size
+                try:
+                    embeddings = await asyncio.get_running_loop().run_in_executor(
+                        self._embed_executor, self._embedding_function, chunks[start:end]
+                    )
+                except requests.exceptions.RequestException as e:
+                    if batch_size == 1:
+                        raise
+                    batch_size = max(1, batch_size // 2)
+                    logger.warning(f"Embedding request failed ({e}). Retrying with batch size {batch_size}")
+                    continue
+                await write_slots.acquire()
+                writes.append(asyncio.create_task(write(start, end, embeddings)))
+                start = end
+        finally:
+            # Wait for every scheduled write, even when embedding failed, so none
+            # is still running once the caller cleans up the partial document
+            results = await asyncio.gather(*writes, return_exceptions=True)
+
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+
     def add_document(
         self, 
         collection_name: str, 
@@ -148,6 +294,31 @@ class ChromaClient:
     ) -> dict:
         """
         Adds a document's chunks to a specific collection.
+        Synchronous wrapper around add_document_async.
+        
+        Args:
+            collection_name: Name of the collection to add to
+            file_path: Path to the PDF file
+            force_reprocess: If True, reprocess even if document exists
+            
+        Returns:
+            dict with status information
+        """
+        return asyncio.run(self.add_document_async(
+            collection_name=collection_name,
+            file_path=file_path,
+            force_reprocess=force_reprocess
+        ))
+
+    async def add_document_async(
+        self, 
+        collection_name: str, 
+        file_path: str,
+        force_reprocess: bool = False
+    ) -> dict:
+        """
+        Adds a document's chunks to a specific collection, overlapping
+        embedding requests with writes to the database.
         
         Args:
             collection_name: Name of the collection to add to
@@ -166,33 +337,28 @@ class ChromaClient:
             raise FileNotFoundError(f"File not found: {file_path}")
 
 
-        # Generate stable document ID
-        doc_id = get_doc_id(file_path=file_path)
+        file_name = os.path.basename(file_path)
+        # Unique key for the source file; the basename is only display metadata
+        source_path = str(Path(file_path).resolve())
+        fingerprint = self._get_file_fingerprint(file_path)
         
-        # Check if document already exists
-        existing_chunks = self._get_existing_chunk_ids(collection, doc_id)
-        if existing_chunks and not force_reprocess:
-            logger.info(f"Document already exists with {len(existing_chunks)} chunks. Use force_reprocess=True to reprocess.")
-            return {
-                "status": "already_exists",
-                "doc_id": doc_id,
-                "existing_chunks": len(existing_chunks),
-                "file": file_path
-            }
-        
-        # Delete existing chunks if reprocessing
-        if existing_chunks and force_reprocess:
-            logger.info(f"Deleting {len(existing_chunks)} existing chunks for reprocessing")
-            try:
-                collection.delete(ids=list(existing_chunks))
-            except Exception as e:
-                logger.error(f"Failed to delete existing chunks: {e}")
+        # Skip parsing entirely if this exact file version is already indexed
+        if not force_reprocess:
+            unchanged = await asyncio.to_thread(self._get_unchanged_document, collection, source_path, fingerprint)
+            if unchanged:
+                logger.info(f"Document unchanged since last ingest with {unchanged['total_chunks']} chunks. Use force_reprocess=True to reprocess.")
+                return {
+                    "status": "already_exists",
+                    "doc_id": unchanged['doc_id'],
+                    "existing_chunks": unchanged['total_chunks'],
+                    "file": file_path
+                }
         
         logger.info(f"Processing document: {file_path}")
         
         # Parse the document
         try:
-            documents_from_parser = parse_pdf_to_md(file_path)
+            documents_from_parser = await asyncio.to_thread(parse_pdf_to_md, file_path)
         except Exception as e:
             logger.error(f"Failed to parse document: {e}")
             raise
@@ -205,10 +371,21 @@ class ChromaClient:
                 "file": file_path
             }
         
-        # Extract text using the safe method
-        full_text_string = self._extract_text_from_documents(documents_from_parser)
+        # Extract text using the safe method, one string per document, hashing each
+        # as it arrives to build a stable document ID (as if joined by blank lines).
+        # The texts are kept, not joined: the doc_id must be known before chunking,
+        # to skip documents that are already indexed.
+        hasher = hashlib.sha256()
+        document_texts = []
+        has_content = False
+        for text in self._extract_text_from_documents(documents_from_parser):
+            if document_texts:
+                hasher.update(b"\n\n")
+            hasher.update(text.encode("utf-8"))
+            document_texts.append(text)
+            has_content = has_content or bool(text.strip())
         
-        if not full_text_string or not full_text_string.strip():
+        if not has_content:
             logger.warning(f"Extracted text is empty for {file_path}")
             return {
                 "status": "skipped",
@@ -216,16 +393,36 @@ class ChromaClient:
                 "file": file_path
             }
         
+        doc_id = hasher.hexdigest()[:16]
+        
+        # Check if document already exists
+        existing_chunks = await asyncio.to_thread(self._get_existing_chunk_ids, collection, doc_id)
+        if existing_chunks and not force_reprocess:
+            logger.info(f"Document already exists with {len(existing_chunks)} chunks. Use force_reprocess=True to reprocess.")
+            return {
+                "status": "already_exists",
+                "doc_id": doc_id,
+                "existing_chunks": len(existing_chunks),
+                "file": file_path
+            }
         
-        # Get chunking settings
-        chunk_settings = self.config['vectorstore']['settings']
+        # Delete existing chunks if reprocessing
+        if existing_chunks and force_reprocess:
+            logger.info(f"Deleting {len(existing_chunks)} existing chunks for reprocessing")
+            try:
+                await asyncio.to_thread(collection.delete, ids=list(existing_chunks))
+            except Exception as e:
+                logger.error(f"Failed to delete existing chunks: {e}")
         
         # Chunk the document
         try:
-            chunks = chunking(
-                document=full_text_string, 
-                chunk_size=chunk_settings.get('chunk_size', 500),
-                chunk_overlap=chunk_settings.get('chunk_overlap', 50)
+            chunks = await asyncio.to_thread(
+                chunking,
+                documents=document_texts,
+                chunk_size=self._chunk_size,
+                chunk_overlap=self._chunk_overlap,
+                tokenizer_name=self._tokenizer_name,
+                min_chunk_size=self._min_chunk_size
             )
         except Exception as e:
             logger.error(f"Failed to chunk document: {e}")
@@ -239,30 +436,28 @@ class ChromaClient:
                 "file": file_path
             }
         
-        # Prepare metadata for each chunk
-        file_name = os.path.basename(file_path)
-        metadatas = [
-            {
-                "source": file_name,
-                "doc_id": doc_id,
-                "chunk_index": i,
-                "total_chunks": len(chunks)
-            } 
-            for i in range(len(chunks))
-        ]
+        # Prepare metadata for each chunk. The document-level keys stay on every
+        # row because the doc_id and fingerprint lookups filter on them.
+        num_chunks = len(chunks)
+        base_metadata = {
+            "source": file_name,
+            "source_path": source_path,
+            "source_fingerprint": fingerprint,
+            "doc_id": doc_id,
+            "total_chunks": num_chunks
+        }
+        metadatas = [{**base_metadata, "chunk_index": i} for i in range(num_chunks)]
         
         # Generate unique IDs for each chunk
-        ids = [f"{doc_id}_chunk_{i}" for i in range(len(chunks))]
+        id_prefix = f"{doc_id}_chunk_"
+        ids = [f"{id_prefix}{i}" for i in range(num_chunks)]
         
         # Add chunks to collection
         logger.info(f"Adding {len(chunks)} chunks to collection '{collection_name}'")
         try:
-            collection.add(
-                documents=chunks,
-                ids=ids,
-                metadatas=metadatas
-            )
+            await self._add_in_batches(collection, chunks, ids, metadatas)
             logger.info(f"Successfully added document with {len(chunks)} chunks")
+            await asyncio.to_thread(self._delete_stale_chunks, collection, source_path, doc_id)
             return {
                 "status": "success",
                 "doc_id": doc_id,
@@ -271,6 +466,11 @@ class ChromaClient:
             }
         except Exception as e:
             logger.error(f"Failed to add chunks to collection: {e}")
+            # Drop the slices already written, so a partial document is never taken as indexed
+            try:
+                await asyncio.to_thread(collection.delete, where={"doc_id": doc_id})
+            except Exception as cleanup_error:
+                logger.error(f"Failed to remove partially added chunks for {doc_id}: {cleanup_error}")
             raise
 
 
@@ -279,10 +479,13 @@ def process_directory(
     collection_name: str,
     directory_path: str,
     pattern: str = "*.pdf",
-    force_reprocess: bool = False
+    force_reprocess: bool = False,
+    max_workers: Optional[int] = None
 ) -> dict:
     """
     Process all files matching pattern in a directory.
+    Files are ingested concurrently, since parsing and embedding are
+    dominated by network waits on LlamaCloud and Ollama.
     
     Args:
         chroma_client: ChromaClient instance
@@ -290,6 +493,8 @@ def process_directory(
         directory_path: Directory to scan
         pattern: File pattern to match (default: "*.pdf")
         force_reprocess: If True, reprocess existing documents
+        max_workers: Number of files processed in parallel
+            (default: the 'ingest_workers' setting)
         
     Returns:
         dict with processing results
@@ -307,28 +512,41 @@ def process_directory(
         "failed": [],
         "skipped": []
     }
+    if not files:
+        return results
     
-    for file_path in files:
-        try:
-            result = chroma_client.add_document(
+    workers = max(1, min(max_workers or chroma_client.ingest_workers, len(files)))
+    
+    # Chroma clients are thread-safe, so each worker writes to the collection directly
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(
+                chroma_client.add_document,
                 collection_name=collection_name,
                 file_path=str(file_path),
                 force_reprocess=force_reprocess
-            )
-            
-            if result["status"] == "success":
-                results["processed"].append(result)
-            elif result["status"] == "skipped":
-                results["skipped"].append(result)
-            else:
-                results["failed"].append(result)
+            ): file_path
+            for file_path in files
+        }
+        
+        for future in as_completed(futures):
+            file_path = futures[future]
+            try:
+                result = future.result()
                 
-        except Exception as e:
-            logger.error(f"Failed to process {file_path}: {e}")
-            results["failed"].append({
-                "file": str(file_path),
-                "error": str(e)
-            })
+                if result["status"] == "success":
+                    results["processed"].append(result)
+                elif result["status"] == "skipped":
+                    results["skipped"].append(result)
+                else:
+                    results["failed"].append(result)
+                    
+            except Exception as e:
+                logger.error(f"Failed to process {file_path}: {e}")
+                results["failed"].append({
+                    "file": str(file_path),
+                    "error": str(e)
+                })
     
     return results
 